@@ -20,15 +20,32 @@ class MetricDataset(Dataset):
             )
         self.data = data
         try:
-            self.cluster_inds = data.obs[obsm_cluster_key]
+            self.cluster_inds = data.obs[obsm_cluster_key].to_numpy()
         except KeyError:
             raise Exception(f"`{obsm_cluster_key}` must be set in the data")
         self.X = self.data.obsm[obsm_data_key]
-        self.unique_clusters = np.unique(self.cluster_inds)
 
         self.indices = np.arange(self.data.shape[0])
-        self.num_clusters = len(self.unique_clusters)
         self.transform = transform
+        self._build_cluster_members()
+
+    def _build_cluster_members(self):
+        # Cache the member indices of each cluster for sampling triplets.
+        # Computed in a single pass by sorting the cells by their cluster
+        order = np.argsort(self.cluster_inds, kind="stable")
+        self.unique_clusters, boundaries = np.unique(
+            self.cluster_inds[order], return_index=True
+        )
+        self.num_clusters = len(self.unique_clusters)
+        self.cluster_members = dict(
+            zip(self.unique_clusters, np.split(self.indices[order], boundaries[1:]))
+        )
+
+    def update_clusters(self, cluster_inds):
+        # Clustering backends relabel clusters on every run so the member
+        # indices are rebuilt for all the clusters
+        self.cluster_inds = np.asarray(cluster_inds)
+        self._build_cluster_members()
 
     def __getitem__(self, idx):
         # Sample the anchor and the positive class
@@ -36,15 +53,12 @@ class MetricDataset(Dataset):
         positive_idx = idx
 
         while positive_idx == idx:
-            positive_idx = np.random.choice(
-                self.indices[self.cluster_inds == pos_class]
-            )
+            positive_idx = np.random.choice(self.cluster_members[pos_class])
         pos_sample = self.X[positive_idx]
 
         # Sample the negative label and sample
         neg_class = np.random.choice(list(set(self.unique_clusters) - set([pos_class])))
-        neg_class_choices = self.cluster_inds == neg_class
-        neg_sample = self.X[np.random.choice(self.indices[neg_class_choices])]
+        neg_sample = self.X[np.random.choice(self.cluster_members[neg_class])]
 
         if self.transform is not None:
             anchor = self.transform(anchor)
@@ -1,3 +1,4 @@
+import numpy as np
 import torch
 from torch.utils.data import Dataset
 
@@ -5,8 +6,10 @@ from torch.utils.data import Dataset
 # Creates a torch dataset from  a numpy array
 class NpDataset(Dataset):
     def __init__(self, X):
-        self.X = torch.Tensor(X)
-        self.shape = self.X.shape
+        # Share memory with X when it is already a contiguous float32 array
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        self.shape = X.shape
+        self.X = torch.from_numpy(X)
 
     def __getitem__(self, idx):
         return self.X[idx]
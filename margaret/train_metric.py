@@ -3,10 +3,15 @@ import os
 import time
 import torch
 import torch.nn as nn
+from torch.utils.data import (
+    BatchSampler,
+    DataLoader,
+    SequentialSampler,
+    TensorDataset,
+)
 from tqdm import tqdm
 
 from datasets.metric import MetricDataset
-from datasets.np import NpDataset
 from models.metric import MetricEncoder
 from utils.trainer import MetricTrainer
 from utils.util import compute_runtime, determine_cell_clusters
@@ -23,6 +28,8 @@ def train_metric_learner(
     random_state=0,
     save_path=os.getcwd(),
     backend="kmeans",
+    eval_batch_size=4096,
+    compile_eval=False,
     nn_kwargs={},
     trainer_kwargs={},
     cluster_kwargs={},
@@ -57,6 +64,12 @@ def train_metric_learner(
     infeatures = X.shape[-1]
     model = MetricEncoder(infeatures, code_size=code_size).to(device)
 
+    # Optionally compile the model for generating embeddings. The eager model
+    # is used for training to avoid recompilation for the backward pass
+    eval_model = model
+    if compile_eval:
+        eval_model = torch.compile(model, mode="reduce-overhead")
+
     # Trainer
     trainer = MetricTrainer(
         dataset,
@@ -67,21 +80,38 @@ def train_metric_learner(
         **trainer_kwargs,
     )
 
+    # Upload the data once for generating embeddings. Batches are gathered
+    # with a single indexing op on the resident tensor
+    embedding_dataset = TensorDataset(
+        torch.from_numpy(np.ascontiguousarray(X, dtype=np.float32)).to(device)
+    )
+    embedding_loader = DataLoader(
+        embedding_dataset,
+        sampler=BatchSampler(
+            SequentialSampler(embedding_dataset), eval_batch_size, drop_last=False
+        ),
+        batch_size=None,
+    )
+
     for episode_idx in range(n_episodes):
         print(f"Training for episode: {episode_idx + 1}")
         epoch_start_time = time.time()
         trainer.train(n_metric_epochs, save_path)
 
         # Generate embeddings
-        embedding = []
-        embedding_dataset = NpDataset(X)
+        embedding = torch.empty((len(embedding_dataset), code_size), device=device)
 
         model.eval()
-        with torch.no_grad():
-            for data in tqdm(embedding_dataset):
-                data = data.to(device)
-                embedding.append(model(data.unsqueeze(0)).squeeze().cpu().numpy())
-        X_embedding = np.array(embedding)
+        with torch.inference_mode(), torch.autocast(
+            device_type="cuda", dtype=torch.float16, enabled=(device == "cuda")
+        ):
+            start_idx = 0
+            for (data,) in tqdm(embedding_loader):
+                end_idx = start_idx + data.shape[0]
+                embedding[start_idx:end_idx] = eval_model(data).float()
+                start_idx = end_idx
+        # Keep the embeddings on the device until all batches are done
+        X_embedding = embedding.cpu().numpy()
 
         adata.obsm["metric_embedding"] = X_embedding
 
@@ -98,9 +128,7 @@ def train_metric_learner(
         clustering_scores.append(score)
 
         # Update the dataset as the cluster assignments have changed
-        dataset = MetricDataset(
-            adata, obsm_data_key=obsm_data_key, obsm_cluster_key="metric_clusters"
-        )
+        dataset.update_clusters(adata.obs["metric_clusters"].to_numpy())
         cluster_record.append(dataset.num_clusters)
         trainer.update_dataset(dataset)
         print(f"Time Elapsed for epoch: {time.time() - epoch_start_time}s")
@@ -15,6 +15,13 @@ from matplotlib.text import Annotation
 from matplotlib.font_manager import FontProperties
 from sklearn.manifold import TSNE
 
+try:
+    from openTSNE import TSNE as OpenTSNE
+
+    _opentsne_available = True
+except ImportError:
+    _opentsne_available = False
+
 from models.ti.graph import (
     compute_connectivity_graph,
     compute_trajectory_graph,
@@ -26,6 +33,15 @@ from utils.util import compute_runtime
 # TODO: In the plotting module, create a decorator to save the plots
 
 
+def _get_cluster_ids(communities):
+    # Categorical labels (as set by scanpy) already know their categories
+    # so avoid sorting the labels of all the cells
+    if isinstance(getattr(communities, "dtype", None), pd.CategoricalDtype):
+        categories = pd.Categorical(communities).remove_unused_categories().categories
+        return np.sort(categories.to_numpy())
+    return np.unique(communities)
+
+
 @compute_runtime
 def generate_plot_embeddings(X, method="tsne", **kwargs):
     if method == "phate":
@@ -33,8 +49,15 @@ def generate_plot_embeddings(X, method="tsne", **kwargs):
         X_phate = phate_op.fit_transform(X)
         return X_phate
     elif method == "tsne":
-        tsne = TSNE(n_components=2, **kwargs)
-        X_tsne = tsne.fit_transform(X)
+        kwargs.setdefault("n_jobs", -1)
+        if _opentsne_available:
+            # openTSNE parallelizes the neighbor search and gradient computation.
+            # Copy the embedding so that the t-SNE state it references can be freed
+            tsne = OpenTSNE(n_components=2, **kwargs)
+            X_tsne = np.array(tsne.fit(X))
+        else:
+            tsne = TSNE(n_components=2, **kwargs)
+            X_tsne = tsne.fit_transform(X)
         return X_tsne
     elif method == "umap":
         u = umap.UMAP(n_components=2, **kwargs)
@@ -236,8 +259,9 @@ def plot_boxplot_expression(
         data_ = pd.DataFrame(data_, index=ad.obs_names, columns=ad.var_names)
 
     if order is not None:
+        cluster_ids = _get_cluster_ids(communities)
         for cluster_id in np.unique(order):
-            assert cluster_id in np.unique(communities)
+            assert cluster_id in cluster_ids
 
     # Set figsize
     plt.figure(figsize=figsize)
@@ -313,17 +337,25 @@ def plot_gene_expression(
 
     assert X_embedded.shape[-1] == 2
     cmap = cm.Spectral_r if cmap is None else cmap
-    raw_data_df = adata.to_df()
-    imputed_data_df = pd.DataFrame(
-        X_imputed, columns=raw_data_df.columns, index=raw_data_df.index
-    )
 
     # Remove genes excluded from the analysis
-    excluded_genes = set(genes) - set(raw_data_df.columns)
+    excluded_genes = set(genes) - set(adata.var_names)
     if len(excluded_genes) != 0:
         print(f"The following genes were not plotted: {excluded_genes}")
 
     net_genes = list(set(genes) - set(excluded_genes))
+
+    # Gather the expression of the genes to be plotted in a single pass
+    gene_cols = adata.var_names.get_indexer(net_genes)
+    if scipy.sparse.issparse(X_imputed):
+        gene_block = X_imputed[:, gene_cols].toarray()
+    else:
+        gene_block = np.asarray(X_imputed)[:, gene_cols]
+    gene_block_idx = {gene: idx for idx, gene in enumerate(net_genes)}
+    if norm:
+        gene_mins = gene_block.min(axis=0)
+        gene_maxs = gene_block.max(axis=0)
+
     ncols = math.ceil(len(net_genes) / nrows)
     gs = plt.GridSpec(nrows=nrows, ncols=ncols)
     fig = plt.figure(figsize=figsize)
@@ -335,12 +367,12 @@ def plot_gene_expression(
                 gene_index = gene_index + 1
                 continue
 
-            gene_expression = imputed_data_df[gene_name].to_numpy()
+            block_idx = gene_block_idx[gene_name]
+            gene_expression = gene_block[:, block_idx]
 
             if norm:
-                gene_expression = (gene_expression - np.min(gene_expression)) / (
-                    np.max(gene_expression) - np.min(gene_expression)
-                )
+                gene_min, gene_max = gene_mins[block_idx], gene_maxs[block_idx]
+                gene_expression = (gene_expression - gene_min) / (gene_max - gene_min)
 
             axes = plt.subplot(gs[row_idx, col_idx])
             sc = axes.scatter(
@@ -392,7 +424,7 @@ def plot_clusters(
         plt.title(title)
     axes = plt.gca()
 
-    for cluster_id in np.unique(communities):
+    for cluster_id in _get_cluster_ids(communities):
         ids = communities == cluster_id
         c = None if color_map is None else color_map[cluster_id]
         axes.scatter(
@@ -445,7 +477,7 @@ def plot_clusters_with_cell_overlay(
         plt.title(title)
     axes = plt.gca()
 
-    for cluster_id in np.unique(communities):
+    for cluster_id in _get_cluster_ids(communities):
         ids = communities == cluster_id
         c = None if color_map is None else color_map[cluster_id]
         axes.scatter(
@@ -558,11 +590,12 @@ def plot_trajectory_graph(
         plt.title(title)
     plt.axis("off")
     edge_weights = [offset + w for _, _, w in g.edges.data("weight")]
+    cluster_ids = _get_cluster_ids(communities)
     nx.draw_networkx(
         g,
         pos=node_positions,
         cmap=cmap,
-        node_color=np.unique(communities),
+        node_color=cluster_ids,
         font_color=font_color,
         node_size=node_size,
         width=edge_weights,
@@ -605,10 +638,11 @@ def plot_trajectory_graph_v2(
 
     start_cluster_ids = set([communities.loc[id] for id in start_cell_ids])
 
-    colors = np.unique(communities)
+    cluster_ids = _get_cluster_ids(communities)
+    colors = cluster_ids
     if node_color is not None:
         colors = []
-        for c_id in np.unique(communities):
+        for c_id in cluster_ids:
             if c_id in start_cluster_ids and start_node_color is not None:
                 colors.append(start_node_color)
             else:
@@ -665,10 +699,11 @@ def plot_connectivity_graph(
 
     start_cluster_ids = set([communities.loc[id] for id in start_cell_ids])
 
-    colors = np.unique(communities)
+    cluster_ids = _get_cluster_ids(communities)
+    colors = cluster_ids
     if node_color is not None:
         colors = []
-        for c_id in np.unique(communities):
+        for c_id in cluster_ids:
             if c_id in start_cluster_ids and start_node_color is not None:
                 colors.append(start_node_color)
             else:
@@ -697,6 +732,8 @@ def plot_connectivity_graph(
 def plot_gt_milestone_network(
     ad,
     uns_mn_key="milestone_network",
+    uns_layout_key="milestone_layout",
+    recompute_layout=False,
     start_node_color="red",
     node_color="yellow",
     figsize=(12, 12),
@@ -710,32 +747,59 @@ def plot_gt_milestone_network(
     # of the milestones, this function uses spring_layout to plot the
     # node positions. Hence the displayed graph is not guaranteed to produce
     # accurate spatial embeddings of milestones in the 2d plane.
+    # The computed layout (along with the edges it was computed for) is stored
+    # in ad.uns[uns_layout_key] and reused in subsequent calls for the same
+    # milestone network unless recompute_layout is set.
     if uns_mn_key not in ad.uns_keys():
         raise Exception(f"Milestone network not found in uns.{uns_mn_key}")
 
-    # Get a set of unique milestones
+    # Construct the milestone network from the edge list
     mn = ad.uns[uns_mn_key]
-    from_milestones = set(mn["from"].unique())
-    to_milestones = set(mn["to"].unique())
-    milestones = from_milestones.union(to_milestones)
+    edges_df = pd.DataFrame(
+        {
+            "source": mn["from"].to_numpy(),
+            "target": mn["to"].to_numpy(),
+            "weight": mn["length"].to_numpy(),
+        }
+    )
+    milestone_network = nx.from_pandas_edgelist(
+        edges_df, edge_attr="weight", create_using=nx.DiGraph
+    )
 
-    # Construct the milestone network
-    milestone_network = nx.DiGraph()
+    # Node colors (in the node order of the network)
     start_milestones = (
         [ad.uns["start_milestones"]]
         if isinstance(ad.uns["start_milestones"], str)
         else list(ad.uns["start_milestones"])
     )
-    color_map = []
-    for milestone in milestones:
-        milestone_network.add_node(milestone)
-        if milestone in start_milestones:
-            color_map.append(start_node_color)
-        else:
-            color_map.append(node_color)
-
-    for idx, (f, t) in enumerate(zip(mn["from"], mn["to"])):
-        milestone_network.add_edge(f, t, weight=mn["length"][idx])
+    start_set = set(start_milestones)
+    color_map = [
+        start_node_color if milestone in start_set else node_color
+        for milestone in milestone_network.nodes
+    ]
+
+    # Reuse the node positions from a previous call if computed for the
+    # same milestone network. Keys are stored as strings to keep the
+    # AnnData writable to h5ad
+    edges = np.column_stack([edges_df["source"], edges_df["target"]]).astype(str)
+    weights = edges_df["weight"].to_numpy()
+    layout = None if recompute_layout else ad.uns.get(uns_layout_key)
+    if (
+        layout is None
+        or "edges" not in layout
+        or not np.array_equal(layout["edges"], edges)
+        or not np.array_equal(layout["weights"], weights)
+    ):
+        pos = nx.spring_layout(milestone_network)
+        ad.uns[uns_layout_key] = {
+            "edges": edges,
+            "weights": weights,
+            "positions": {str(node): p for node, p in pos.items()},
+        }
+    else:
+        pos = {
+            node: layout["positions"][str(node)] for node in milestone_network.nodes
+        }
 
     # Draw graph
     plt.figure(figsize=figsize)
@@ -743,7 +807,7 @@ def plot_gt_milestone_network(
     edge_weights = [1 + w for _, _, w in milestone_network.edges.data("weight")]
     nx.draw_networkx(
         milestone_network,
-        pos=nx.spring_layout(milestone_network),
+        pos=pos,
         node_size=node_size,
         width=edge_weights,
         node_color=color_map,
@@ -886,12 +950,10 @@ def plot_connectivity_graph_with_gene_expressions(
         raise Exception(f"Key {comm_key} not found in {ad}")
 
     try:
-        X_imputed = pd.DataFrame(
-            ad.obsm[magic_key], index=ad.obs_names, columns=ad.var_names
-        )
+        X_imputed = ad.obsm[magic_key]
     except KeyError:
         print("MAGIC imputed data not found. Using raw counts instead")
-        X_imputed = ad.to_df()
+        X_imputed = ad.X
 
     if gene not in ad.var_names:
         raise ValueError(f"Gene: {gene} was not found.")
@@ -900,11 +962,16 @@ def plot_connectivity_graph_with_gene_expressions(
         X_embedded, communities, cluster_connectivities, mode=mode
     )
 
+    # Only gather the column of the gene instead of densifying all the data
+    X_gene = X_imputed[:, ad.var_names.get_loc(gene)]
+    if scipy.sparse.issparse(X_gene):
+        X_gene = X_gene.toarray()
+    X_gene = pd.Series(np.ravel(X_gene), index=ad.obs_names)
+
     # Normalize and compute cluster wise mean expression of the gene
-    X_gene = X_imputed[gene]
     X_gene = (X_gene - X_gene.min()) / (X_gene.max() - X_gene.min())
     gene_exprs = []
-    for cluster_id in np.unique(communities):
+    for cluster_id in _get_cluster_ids(communities):
         ids = communities == cluster_id
         mean_gene_expr = X_gene.loc[ids].mean()
         gene_exprs.append(mean_gene_expr)
@@ -1014,9 +1081,10 @@ def plot_dp_vs_pseudotime(
     lineage_cell_ids = []
     colors = []
     comms = ad.obs[comms_key]
+    cluster_ids = _get_cluster_ids(comms)
 
     for cluster_id in lineage:
-        assert cluster_id in np.unique(comms)
+        assert cluster_id in cluster_ids
         cell_ids = list(comms.index[comms == cluster_id])
         lineage_cell_ids.extend(cell_ids)
 
@@ -1076,7 +1144,7 @@ def plot_de_comparison(
     cells_id2 = list(comms.index[comms == id2])
 
     cell_ids = cells_id1 + cells_id2
-    cells_gene_expr = ad.to_df().loc[cell_ids, :]
+    cells_gene_expr = ad[cell_ids, :].X
 
     # New anndata object
     ad2 = sc.AnnData(cells_gene_expr)
@@ -11,6 +11,13 @@ from sklearn.cluster import KMeans
 from sklearn.decomposition import PCA
 from sklearn.metrics import pairwise_distances
 
+try:
+    import faiss
+
+    _faiss_available = True
+except ImportError:
+    _faiss_available = False
+
 
 def compute_runtime(func):
     @wraps(func)
@@ -153,22 +160,82 @@ def run_pca(
     return X_pca, pca.explained_variance_ratio_, n_comps
 
 
+def compute_knn_graph(X, n_neighbors=15, use_gpu=False):
+    """Computes a symmetric kNN connectivity graph using an exact FAISS index
+
+    Args:
+        X (np.ndarray): Input data of shape (n_samples, n_features)
+        n_neighbors (int, optional): No of nearest neighbors per sample. Defaults to 15.
+        use_gpu (bool, optional): Whether to run the kNN search on the GPU. Defaults to False.
+
+    Returns:
+        [csr_matrix]: Binary adjacency matrix of shape (n_samples, n_samples)
+    """
+    if not _faiss_available:
+        raise Exception("Install faiss to use the `faiss` kNN backend")
+
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    n_samples = X.shape[0]
+    if n_neighbors >= n_samples:
+        raise ValueError(
+            f"n_neighbors ({n_neighbors}) must be less than the number of samples ({n_samples})"
+        )
+    index = faiss.IndexFlatL2(X.shape[-1])
+    if use_gpu:
+        index = faiss.index_cpu_to_gpu(faiss.StandardGpuResources(), 0, index)
+    index.add(X)
+
+    # Remove self matches (not necessarily in the first column when there are
+    # duplicate samples) and padded (-1) entries and keep n_neighbors per sample
+    _, knn_inds = index.search(X, n_neighbors + 1)
+    sample_inds = np.arange(n_samples)[:, None]
+    valid = (knn_inds != sample_inds) & (knn_inds >= 0)
+    valid &= np.cumsum(valid, axis=1) <= n_neighbors
+    rows = np.broadcast_to(sample_inds, knn_inds.shape)[valid]
+    cols = knn_inds[valid]
+    adj = csr_matrix(
+        (np.ones(len(cols), dtype=np.float32), (rows, cols)),
+        shape=(n_samples, n_samples),
+    )
+    return adj.maximum(adj.T)
+
+
 @compute_runtime
 def determine_cell_clusters(
     data,
     obsm_key="X_pca",
     backend="phenograph",
     cluster_key="clusters",
+    knn_backend="scanpy",
     nn_kwargs={},
     **kwargs,
 ):
-    """Run clustering of cells"""
+    """Run clustering of cells. For the `louvain` and `leiden` backends the kNN
+    graph is computed using `sc.pp.neighbors` when knn_backend is `scanpy` or
+    using `compute_knn_graph` when knn_backend is `faiss`. nn_kwargs are passed
+    to the selected kNN backend, hence with the `faiss` backend only
+    `n_neighbors` and `use_gpu` are supported. The `phenograph` and `kmeans`
+    backends do not use a kNN graph and only support the `scanpy` kNN backend."""
     if not isinstance(data, sc.AnnData):
         raise Exception(f"Expected data to be of type sc.AnnData found : {type(data)}")
     try:
         X = data.obsm[obsm_key]
     except KeyError:
         raise Exception(f"Either `X_pca` or `{obsm_key}` must be set in the data")
+    if knn_backend not in ["scanpy", "faiss"]:
+        raise NotImplementedError(
+            f"The kNN backend {knn_backend} is not supported yet!"
+        )
+    if knn_backend != "scanpy" and backend not in ["louvain", "leiden"]:
+        raise ValueError(
+            f"The kNN backend {knn_backend} is only used by the louvain and leiden backends"
+        )
+    if knn_backend == "faiss":
+        unsupported_keys = set(nn_kwargs) - set(["n_neighbors", "use_gpu"])
+        if len(unsupported_keys) != 0:
+            raise ValueError(
+                f"nn_kwargs {unsupported_keys} are not supported by the faiss kNN backend"
+            )
     if backend == "phenograph":
         clusters, _, score = phenograph.cluster(X, **kwargs)
         data.obs[cluster_key] = clusters
@@ -179,15 +246,23 @@ def determine_cell_clusters(
         data.obs[cluster_key] = clusters
     elif backend == "louvain":
         # Compute nearest neighbors
-        sc.pp.neighbors(data, use_rep=obsm_key, **nn_kwargs)
-        sc.tl.louvain(data, key_added=cluster_key, **kwargs)
+        if knn_backend == "faiss":
+            adj = compute_knn_graph(X, **nn_kwargs)
+            sc.tl.louvain(data, adjacency=adj, key_added=cluster_key, **kwargs)
+        else:
+            sc.pp.neighbors(data, use_rep=obsm_key, **nn_kwargs)
+            sc.tl.louvain(data, key_added=cluster_key, **kwargs)
         data.obs[cluster_key] = data.obs[cluster_key].to_numpy().astype(np.int)
         clusters = data.obs[cluster_key]
         score = None
     elif backend == "leiden":
         # Compute nearest neighbors
-        sc.pp.neighbors(data, use_rep=obsm_key, **nn_kwargs)
-        sc.tl.leiden(data, key_added=cluster_key, **kwargs)
+        if knn_backend == "faiss":
+            adj = compute_knn_graph(X, **nn_kwargs)
+            sc.tl.leiden(data, adjacency=adj, key_added=cluster_key, **kwargs)
+        else:
+            sc.pp.neighbors(data, use_rep=obsm_key, **nn_kwargs)
+            sc.tl.leiden(data, key_added=cluster_key, **kwargs)
         data.obs[cluster_key] = data.obs[cluster_key].to_numpy().astype(np.int)
         clusters = data.obs[cluster_key]
         score = None